@@ -78,6 +78,13 @@ class Parameters:
     # Minimum blob area in pixels (filter out small noise)
     min_area: int = 300
 
+    # Horizontal band of interest, as percent of frame height.
+    # Pillars and walls live in the middle of the image; rows above
+    # roi_top / below roi_bottom are skipped by detection entirely.
+    # Defaults keep the full frame so behavior is unchanged until tuned.
+    roi_top: int = 0
+    roi_bottom: int = 100
+
     # ── Methods ─────────────────────────────────────────────────
 
     def update(self, **kwargs):
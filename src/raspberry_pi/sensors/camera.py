@@ -23,23 +23,50 @@ REFERENCE to the same object that the web server modifies.
 
 import threading
 import time
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import astuple, dataclass
 
 import cv2
 import numpy as np
 
 from params import Parameters
 
+# OpenCV tuning. setUseOptimized is the default on, but asserting it is
+# free and protects against a build that shipped with it off - it gates
+# the NEON/SIMD code paths cvtColor and inRange rely on. Pin OpenCV's
+# internal pool to 2 threads so it doesn't oversubscribe the Pi's four
+# cores, which our capture thread, color workers and aiohttp already use.
+cv2.setUseOptimized(True)
+cv2.setNumThreads(2)
+
 # Camera settings
 CAMERA_INDEX = 0
 CAMERA_WIDTH = 640
 CAMERA_HEIGHT = 480
 CAMERA_FOV = 120  # degrees (wide-angle lens)
 
+# Run blob detection on every Nth captured frame. The stream keeps full
+# FPS; detection at half rate roughly halves CPU with no visible lag.
+DETECT_INTERVAL = 2
+
+# Number of recent frames covered by the timing metrics (~4 s at 30 FPS)
+METRICS_WINDOW = 120
+
+# Morphology kernel for mask cleanup. Allocated ONCE at import time:
+# np.ones() in the per-frame path would rebuild this for every mask.
+MORPH_KERNEL = np.ones((5, 5), np.uint8)
 
-@dataclass
+# Labels used in the per-frame color map (0 = background)
+COLOR_LABELS = {1: "red", 2: "green", 3: "magenta"}
+
+
+@dataclass(slots=True)
 class ColorBlob:
-    """A detected colored region in the camera frame."""
+    """A detected colored region in the camera frame.
+
+    slots=True skips the per-instance __dict__: these are created in
+    batches every detection frame, so the smaller/faster instances add up.
+    """
 
     color: str      # "red", "green", "magenta"
     angle: float    # Degrees from center (-60 to +60 for 120 FOV)
@@ -83,11 +110,53 @@ class Camera:
 
         self._frame: np.ndarray | None = None
         self._blobs: list[ColorBlob] = []
+        self._timestamp = 0.0  # monotonic time of the published frame
+
+        # Last encoded JPEG: (timestamp, quality, bytes). Every connected
+        # browser pulls the stream, so encode each frame at most once.
+        self._jpeg_cache: tuple[float, int, bytes] | None = None
+
+        # Cached HSV bound arrays, rebuilt only when params change
+        self._bounds: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        self._bounds_key: tuple | None = None
+        self._red_lut: np.ndarray | None = None  # red hue lookup table
+
+        # Reused buffer for drawing bounding boxes in get_jpeg_frame
+        self._annotated: np.ndarray | None = None
+
+        # Reused buffer for the unioned detection mask
+        self._union: np.ndarray | None = None
+
+        # Ring buffers of recent loop timings (seconds). Written only by
+        # the capture thread; readers just average them, so no lock.
+        self._frame_intervals = np.zeros(METRICS_WINDOW)
+        self._detect_times = np.zeros(METRICS_WINDOW)
+        self._metric_idx = 0
+
+        # Worker pool for the per-color mask builds; created in start()
+        # and torn down in stop() so a stop()/start() cycle gets a fresh
+        # pool. OpenCV releases the GIL inside inRange, so the three
+        # colors really do run on separate Pi cores.
+        self._pool: ThreadPoolExecutor | None = None
 
     @property
     def is_running(self) -> bool:
         return self._running
 
+    def get_stats(self) -> dict:
+        """Capture/detect timings averaged over the last METRICS_WINDOW frames.
+
+        Cheap enough to poll from the web UI: the loop itself only pays
+        two ndarray writes per frame.
+        """
+        intervals = self._frame_intervals[self._frame_intervals > 0]
+        detects = self._detect_times[self._detect_times > 0]
+        return {
+            "fps": round(1.0 / intervals.mean(), 1) if intervals.size else 0.0,
+            "detect_ms": round(detects.mean() * 1000, 2) if detects.size else 0.0,
+            "frames": self._metric_idx,
+        }
+
     def start(self) -> bool:
         """Open camera and start capturing in background."""
         if self._running:
@@ -96,12 +165,17 @@ class Camera:
         self._cap = cv2.VideoCapture(CAMERA_INDEX)
         self._cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_WIDTH)
         self._cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_HEIGHT)
+        # Single capture buffer: read() always returns the NEWEST frame
+        # instead of draining a queue of stale ones, which matters when
+        # detection briefly falls behind the camera's frame rate.
+        self._cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 
         if not self._cap.isOpened():
             print("ERROR: Failed to open camera")
             return False
 
         self._running = True
+        self._pool = ThreadPoolExecutor(max_workers=3, thread_name_prefix="color")
         self._thread = threading.Thread(target=self._capture_loop, daemon=True)
         self._thread.start()
 
@@ -117,27 +191,52 @@ class Camera:
         if self._cap:
             self._cap.release()
             self._cap = None
+        if self._pool:
+            self._pool.shutdown(wait=False)
+            self._pool = None
         print("Camera stopped")
 
     def get_blobs(self) -> list[ColorBlob]:
-        """Get all detected color blobs."""
+        """Get all detected color blobs.
+
+        The capture loop publishes a brand-new list each frame and never
+        mutates a published one, so handing out the reference is safe.
+        """
         with self._lock:
-            return self._blobs.copy()
+            return self._blobs
 
     def get_frame(self) -> np.ndarray | None:
-        """Get latest frame (BGR format)."""
+        """Get latest frame (BGR format).
+
+        Returns the published buffer directly - treat it as READ-ONLY.
+        cap.read() hands the capture loop a fresh ndarray every frame, so
+        nothing ever writes into a frame once it has been published and
+        the old 640x480x3 copy per call was pure overhead.
+        """
         with self._lock:
-            if self._frame is not None:
-                return self._frame.copy()
-            return None
+            return self._frame
 
     def get_jpeg_frame(self, quality: int = 80) -> bytes | None:
         """Get frame with bounding boxes as JPEG bytes."""
         with self._lock:
-            if self._frame is None:
-                return None
-            frame = self._frame.copy()
-            blobs = self._blobs.copy()
+            frame = self._frame
+            blobs = self._blobs
+            stamp = self._timestamp
+        if frame is None:
+            return None
+
+        # Serve the cached encode if this frame was already converted at
+        # the same quality (typical when several clients watch the stream).
+        cached = self._jpeg_cache
+        if cached is not None and cached[0] == stamp and cached[1] == quality:
+            return cached[2]
+
+        # Draw into a private reused buffer (double buffering) rather than
+        # allocating a copy of the published frame on every call.
+        if self._annotated is None or self._annotated.shape != frame.shape:
+            self._annotated = np.empty_like(frame)
+        np.copyto(self._annotated, frame)
+        frame = self._annotated
 
         colors = {
             "red": (0, 0, 255),
@@ -155,24 +254,31 @@ class Camera:
             )
 
         ret, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
-        return jpeg.tobytes() if ret else None
-
-    def get_jpeg_mask(self, color: str, quality: int = 80) -> bytes | None:
-        """Get binary color mask as JPEG bytes."""
+        if not ret:
+            return None
+        data = jpeg.tobytes()
+        self._jpeg_cache = (stamp, quality, data)
+        return data
+
+    def get_jpeg_mask(self, color: str, quality: int = 60) -> bytes | None:
+        """Get binary color mask as JPEG bytes.
+
+        Masks are flat black/white, so they survive aggressive
+        compression: encode at half resolution (nearest-neighbor keeps
+        the edges hard) and lower quality. Roughly a quarter of the
+        encode cost of the main stream with no visible difference in the
+        tuning UI, where the mask panels are small anyway.
+        """
         with self._lock:
-            if self._frame is None:
-                return None
-            frame = self._frame.copy()
+            frame = self._frame
+        if frame is None:
+            return None
 
+        # cvtColor only reads the frame, so no defensive copy needed
         hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
 
         if color == "red":
-            lower1, upper1 = self._range("red1")
-            lower2, upper2 = self._range("red2")
-            mask = cv2.bitwise_or(
-                cv2.inRange(hsv, lower1, upper1),
-                cv2.inRange(hsv, lower2, upper2),
-            )
+            mask = self._red_mask(hsv)
         elif color == "green":
             lower, upper = self._range("green")
             mask = cv2.inRange(hsv, lower, upper)
@@ -182,94 +288,201 @@ class Camera:
         else:
             return None
 
+        mask = cv2.resize(mask, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_NEAREST)
         ret, jpeg = cv2.imencode(".jpg", mask, [cv2.IMWRITE_JPEG_QUALITY, quality])
         return jpeg.tobytes() if ret else None
 
     # ── Private methods ──────────────────────────────────────────
 
     def _range(self, color: str):
-        """Build (lower, upper) HSV numpy arrays from params.
+        """Return cached (lower, upper) HSV numpy arrays for a color.
 
-        THIS is the key difference from Stage 2.
-        Stage 2: used hardcoded constants like RED_LOWER1 = np.array([0, 100, 100])
-        Stage 3: reads from self.params every time this is called.
-
-        Since _detect_blobs() calls _range() every frame, any changes
-        to params take effect on the very next frame.
+        Params can still change at runtime - we compare a tuple of all
+        param values against the one the cache was built from, and only
+        rebuild the six np.array pairs when something actually moved.
+        Sliders change maybe once a second; frames come 30x a second, so
+        the cheap tuple compare wins over six np.array() calls per frame.
         """
-        p = self.params
-        if color == "red1":
-            return (np.array([p.red_h_min, p.red_s_min, p.red_v_min]),
-                    np.array([p.red_h_max, p.red_s_max, p.red_v_max]))
-        if color == "red2":
-            return (np.array([p.red_h_min2, p.red_s_min2, p.red_v_min2]),
-                    np.array([p.red_h_max2, p.red_s_max2, p.red_v_max2]))
-        if color == "green":
-            return (np.array([p.green_h_min, p.green_s_min, p.green_v_min]),
-                    np.array([p.green_h_max, p.green_s_max, p.green_v_max]))
-        # magenta
-        return (np.array([p.magenta_h_min, p.magenta_s_min, p.magenta_v_min]),
-                np.array([p.magenta_h_max, p.magenta_s_max, p.magenta_v_max]))
+        key = astuple(self.params)
+        if key != self._bounds_key:
+            p = self.params
+            self._bounds = {
+                # S/V gate for red; the hue test lives in _red_lut. The
+                # limits are the union of both red ranges (in practice
+                # they are always tuned to the same values).
+                "red_sv": (np.array([0, min(p.red_s_min, p.red_s_min2),
+                                     min(p.red_v_min, p.red_v_min2)]),
+                           np.array([180, max(p.red_s_max, p.red_s_max2),
+                                     max(p.red_v_max, p.red_v_max2)])),
+                "green": (np.array([p.green_h_min, p.green_s_min, p.green_v_min]),
+                          np.array([p.green_h_max, p.green_s_max, p.green_v_max])),
+                "magenta": (np.array([p.magenta_h_min, p.magenta_s_min, p.magenta_v_min]),
+                            np.array([p.magenta_h_max, p.magenta_s_max, p.magenta_v_max])),
+            }
+            # Lookup table marking every red hue, from BOTH intervals.
+            # cv2.LUT wants 256 entries even though hue stops at 180.
+            lut = np.zeros(256, np.uint8)
+            lut[p.red_h_min:p.red_h_max + 1] = 255
+            lut[p.red_h_min2:p.red_h_max2 + 1] = 255
+            self._red_lut = lut
+            self._bounds_key = key
+        return self._bounds[color]
+
+    def _red_mask(self, hsv: np.ndarray) -> np.ndarray:
+        """Build the red mask in a single pass despite the hue wraparound.
+
+        Red spans both ends of the hue axis, so the old code ran inRange
+        twice and OR-ed two full-size masks. A hue lookup table handles
+        both intervals in one cv2.LUT sweep; a single inRange then gates
+        saturation and value.
+        """
+        lower, upper = self._range("red_sv")  # also refreshes _red_lut
+        # extractChannel gives a contiguous hue plane (a [:, :, 0] view
+        # is strided, which cv2.LUT rejects)
+        hue_mask = cv2.LUT(cv2.extractChannel(hsv, 0), self._red_lut)
+        return cv2.bitwise_and(hue_mask, cv2.inRange(hsv, lower, upper))
 
     def _capture_loop(self):
         """Background thread: grab frames and run detection."""
+        frame_idx = 0
+        blobs: list[ColorBlob] = []
+        last = time.monotonic()
         while self._running:
             ret, frame = self._cap.read()
             if not ret:
                 continue
-            blobs = self._detect_blobs(frame)
+            grabbed = time.monotonic()
+            # Detect on every DETECT_INTERVAL-th frame only. Skipped
+            # frames republish the previous blobs (hysteresis), so the
+            # boxes hold steady instead of blinking on and off.
+            detect_s = 0.0
+            if frame_idx % DETECT_INTERVAL == 0:
+                blobs = self._detect_blobs(frame)
+                detect_s = time.monotonic() - grabbed
+            frame_idx += 1
+
+            # Timing metrics: two plain ndarray writes per frame
+            slot = self._metric_idx % METRICS_WINDOW
+            self._frame_intervals[slot] = grabbed - last
+            self._detect_times[slot] = detect_s
+            self._metric_idx += 1
+            last = grabbed
             with self._lock:
                 self._frame = frame
                 self._blobs = blobs
+                self._timestamp = time.monotonic()
 
     def _detect_blobs(self, frame: np.ndarray) -> list[ColorBlob]:
         """Detect colored blobs using current params."""
-        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-        blobs = []
+        # Crop to the horizontal band of interest BEFORE converting to
+        # HSV, so every downstream step (inRange, morphology, contours)
+        # touches only the rows that can actually contain targets.
+        top, bottom = self._roi_rows(frame.shape[0])
+        hsv = cv2.cvtColor(frame[top:bottom], cv2.COLOR_BGR2HSV)
 
         # Read min_area from params (not a constant!)
         min_area = self.params.min_area
 
-        # Red (two ranges)
-        rl1, ru1 = self._range("red1")
-        rl2, ru2 = self._range("red2")
-        mask_red = cv2.bitwise_or(
-            cv2.inRange(hsv, rl1, ru1),
-            cv2.inRange(hsv, rl2, ru2),
-        )
-        blobs.extend(self._find_blobs(mask_red, "red", min_area))
-
-        # Green
+        # Fetch bounds on THIS thread first: the cache rebuild in _range
+        # is not thread-safe, and warming it here leaves the workers with
+        # nothing but GIL-free OpenCV calls.
         gl, gu = self._range("green")
-        blobs.extend(self._find_blobs(cv2.inRange(hsv, gl, gu), "green", min_area))
-
-        # Magenta
         ml, mu = self._range("magenta")
-        blobs.extend(self._find_blobs(cv2.inRange(hsv, ml, mu), "magenta", min_area))
-
-        return blobs
-
-    def _find_blobs(self, mask: np.ndarray, color: str, min_area: int) -> list[ColorBlob]:
-        """Find blobs in a binary mask."""
-        blobs = []
-        kernel = np.ones((5, 5), np.uint8)
-        mask = cv2.erode(mask, kernel, iterations=1)
-        mask = cv2.dilate(mask, kernel, iterations=2)
-        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        for contour in contours:
-            area = cv2.contourArea(contour)
-            if area < min_area:
+        self._range("red_sv")
+
+        # Build the three masks in parallel, one color per core.
+        f_red = self._pool.submit(self._red_mask, hsv)
+        f_green = self._pool.submit(cv2.inRange, hsv, gl, gu)
+        f_magenta = self._pool.submit(cv2.inRange, hsv, ml, mu)
+        mask_red = f_red.result()
+        mask_green = f_green.result()
+        mask_magenta = f_magenta.result()
+
+        # Union the masks into ONE image instead of running morphology and
+        # contour search three times per frame. The color map remembers
+        # which color each pixel matched, so we can label blobs afterwards.
+        color_map = np.zeros(mask_red.shape, np.uint8)
+        color_map[mask_magenta > 0] = 3
+        color_map[mask_green > 0] = 2
+        color_map[mask_red > 0] = 1
+
+        # OR the masks into one reused buffer. With dst= OpenCV writes in
+        # place instead of allocating a fresh mask per OR; the inRange
+        # outputs are contiguous uint8, which keeps the OR on OpenCV's
+        # wide (word-at-a-time) fast path.
+        if self._union is None or self._union.shape != mask_red.shape:
+            self._union = np.empty_like(mask_red)
+        cv2.bitwise_or(mask_red, mask_green, dst=self._union)
+        cv2.bitwise_or(self._union, mask_magenta, dst=self._union)
+
+        return self._find_blobs(self._union, color_map, min_area, y_offset=top)
+
+    def _roi_rows(self, height: int) -> tuple[int, int]:
+        """Clamp the params ROI percentages to valid pixel rows."""
+        p = self.params
+        top = height * p.roi_top // 100
+        bottom = height * p.roi_bottom // 100
+        if not 0 <= top < bottom <= height:
+            return 0, height  # nonsense values -> full frame
+        return top, bottom
+
+    def _find_blobs(self, union: np.ndarray, color_map: np.ndarray,
+                    min_area: int, y_offset: int = 0) -> list[ColorBlob]:
+        """Find blobs in the unioned mask and label each one by color."""
+        # Open (erode + dilate) kills small noise, the extra dilate grows
+        # the surviving blobs back - same result as the old erode(1)/dilate(2)
+        # pair but with one fused OpenCV call for the open step.
+        union = cv2.morphologyEx(union, cv2.MORPH_OPEN, MORPH_KERNEL)
+        union = cv2.dilate(union, MORPH_KERNEL, iterations=1)
+
+        # Connected components instead of findContours: one labeling pass
+        # hands back bounding box and pixel area per blob directly, with
+        # no contour polygon lists to build or walk. stats row 0 is the
+        # background; area here is the filled pixel count, which for our
+        # solid pillar blobs matches contourArea closely.
+        count, _, stats, _ = cv2.connectedComponentsWithStats(union)
+        if count <= 1:
+            return []
+        stats = stats[1:]
+        stats = stats[stats[:, cv2.CC_STAT_AREA] >= min_area]
+
+        boxes = []
+        for x, y, w, h, area in stats:
+            color = self._blob_color(color_map, x, y, w, h)
+            if color is None:
                 continue
-            x, y, w, h = cv2.boundingRect(contour)
-            center_x = x + w // 2
-            center_y = y + h // 2
-            angle = self._pixel_to_angle(center_x)
-            blobs.append(ColorBlob(color, angle, center_x, center_y, w, h, int(area)))
-
-        return blobs
-
-    def _pixel_to_angle(self, pixel_x: int) -> float:
-        """Convert X pixel position to angle from center."""
+            boxes.append((color, int(x), int(y), int(w), int(h), int(area)))
+
+        if not boxes:
+            return []
+
+        # Convert all blob centers to angles in one vectorized pass
+        # instead of doing the arithmetic per blob in Python.
+        center_x = np.fromiter((x + w // 2 for _, x, _, w, _, _ in boxes), dtype=np.intp)
+        angles = self._pixels_to_angles(center_x)
+
+        return [
+            # y_offset maps coordinates from the cropped ROI band back
+            # into full-frame pixel space.
+            ColorBlob(color, float(angle), x + w // 2, y_offset + y + h // 2, w, h, area)
+            for (color, x, y, w, h, area), angle in zip(boxes, angles)
+        ]
+
+    @staticmethod
+    def _blob_color(color_map: np.ndarray, x: int, y: int, w: int, h: int) -> str | None:
+        """Pick the dominant color label inside a blob's bounding box.
+
+        Dilation can merge a blob with a few stray pixels of another color,
+        so we count label pixels in the box and take the majority instead
+        of trusting a single centroid sample.
+        """
+        counts = np.bincount(color_map[y:y + h, x:x + w].ravel(), minlength=4)
+        counts[0] = 0  # ignore background
+        label = int(counts.argmax())
+        return COLOR_LABELS.get(label) if counts[label] > 0 else None
+
+    @staticmethod
+    def _pixels_to_angles(pixel_x: np.ndarray) -> np.ndarray:
+        """Convert X pixel positions to angles from center (vectorized)."""
         normalized = (pixel_x - CAMERA_WIDTH / 2) / (CAMERA_WIDTH / 2)
         return normalized * (CAMERA_FOV / 2)
@@ -20,8 +20,12 @@ No restart needed! The Camera reads params every frame.
 """
 
 import asyncio
+import hashlib
 import json
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
+from functools import partial
 from pathlib import Path
 
 from aiohttp import web
@@ -30,6 +34,107 @@ from params import Parameters
 
 TEMPLATES_DIR = Path(__file__).parent / "templates"
 
+# MJPEG part envelope, built once. The per-frame b"--frame..." + jpeg +
+# b"\r\n" concatenation allocated and copied a fresh bytes object for
+# every frame of every connected client.
+_MJPEG_PREFIX = b"--frame\r\nContent-Type: image/jpeg\r\n\r\n"
+_MJPEG_SUFFIX = b"\r\n"
+
+# Served when a template file is missing (e.g. running from an
+# incomplete checkout). Encoded once at import time rather than
+# formatting a page per request.
+_FALLBACK_HTML = (
+    "<!DOCTYPE html><html><head><title>WRO robot</title></head><body>"
+    "<h1>Template missing</h1>"
+    "<p>templates/camera.html was not found. The camera stream is still "
+    'available at <a href="/stream/camera">/stream/camera</a>.</p>'
+    "</body></html>"
+).encode()
+
+
+class FrameBroker:
+    """Fans one stream of encoded frames out to many clients.
+
+    Each MJPEG handler used to wake on its own asyncio.sleep timer and
+    pull get_jpeg_*() itself, so N clients meant N polls per tick and up
+    to a full tick of staleness. A broker runs ONE producer task that
+    grabs a frame at the source rate, bumps a sequence number and
+    notify_all()s; every subscribed handler just waits for a newer
+    sequence number and writes the shared bytes. Work per tick is now
+    independent of the client count.
+    """
+
+    def __init__(self, grab, interval: float = 0.05, executor=None):
+        self._grab = grab  # () -> bytes | None
+        self._interval = interval
+        self._executor = executor  # where grab/encode runs (None = inline)
+        self._cond = asyncio.Condition()
+        self._seq = 0
+        self._jpeg: bytes | None = None
+        self._task: asyncio.Task | None = None
+        self._subscribers = 0
+
+    def add_subscriber(self):
+        """Register a client; the first one starts the producer task."""
+        self._subscribers += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._produce())
+
+    def remove_subscriber(self):
+        """Unregister a client; the last one out stops the producer.
+
+        Without this, one visit to the tuning page would leave all four
+        producers grabbing and encoding frames forever - mask streams
+        must only cost CPU while someone is actually watching them.
+        """
+        self._subscribers -= 1
+        if self._subscribers <= 0 and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _produce(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # The grab includes cv2.imencode, which takes ~10 ms - far
+            # too long to run on the event loop next to socket writes.
+            # cv2 releases the GIL, so the executor thread genuinely
+            # overlaps with the loop.
+            try:
+                if self._executor is not None:
+                    jpeg = await loop.run_in_executor(self._executor, self._grab)
+                else:
+                    jpeg = self._grab()
+            except Exception as e:
+                # One bad frame (e.g. a cv2.error mid-capture) must not
+                # kill the producer: every subscriber would then block in
+                # next_frame forever. Log it and try again next tick.
+                # CancelledError is not caught, so stop() still works.
+                print(f"ERROR: stream producer: {e}")
+                jpeg = None
+            if jpeg is not None:
+                async with self._cond:
+                    self._seq += 1
+                    self._jpeg = jpeg
+                    self._cond.notify_all()
+            await asyncio.sleep(self._interval)
+
+    async def next_frame(self, last_seq: int) -> tuple[int, bytes]:
+        """Block until a frame newer than last_seq is published."""
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: self._seq != last_seq and self._jpeg is not None
+            )
+            return self._seq, self._jpeg
+
 
 class WebServer:
     """Web server with camera stream and parameter tuning."""
@@ -39,65 +144,137 @@ class WebServer:
         self.params = params
         self.app = web.Application()
 
-        # Pages
-        self.app.router.add_get("/", self.index)
+        # One dedicated thread does ALL JPEG encoding for the web side,
+        # shared by every broker: encode cost stays O(1) in the number
+        # of sources and clients, and never blocks the event loop.
+        self._jpeg_executor = ThreadPoolExecutor(max_workers=1,
+                                                 thread_name_prefix="jpeg")
+
+        # One broker per stream source: camera overlay + the three masks
+        self._brokers = {
+            "camera": FrameBroker(camera.get_jpeg_frame,
+                                  executor=self._jpeg_executor),
+            "red": FrameBroker(partial(camera.get_jpeg_mask, "red"),
+                               executor=self._jpeg_executor),
+            "green": FrameBroker(partial(camera.get_jpeg_mask, "green"),
+                                 executor=self._jpeg_executor),
+            "magenta": FrameBroker(partial(camera.get_jpeg_mask, "magenta"),
+                                   executor=self._jpeg_executor),
+        }
+        self.app.on_cleanup.append(self._on_cleanup)
+        self.app.on_response_prepare.append(self._on_response_prepare)
 
-        # Streams
-        self.app.router.add_get("/stream/camera", self.stream_camera)
-        self.app.router.add_get("/stream/camera/{color}", self.stream_camera_mask)
+        # Template cache: name -> (mtime_ns, html, etag)
+        self._template_cache: dict[str, tuple[int, str, str]] = {}
 
-        # Parameters API (NEW in Stage 3)
-        self.app.router.add_get("/api/params", self.api_params_get)
-        self.app.router.add_post("/api/params", self.api_params_set)
+        # All routes in one add_routes call: aiohttp builds its resource
+        # table in a single pass instead of re-deriving it per add_get.
+        self.app.add_routes([
+            # Pages
+            web.get("/", self.index),
+            # Streams
+            web.get("/stream/camera", self.stream_camera),
+            web.get("/stream/camera/{color}", self.stream_camera_mask),
+            # Parameters API (NEW in Stage 3)
+            web.get("/api/params", self.api_params_get),
+            web.post("/api/params", self.api_params_set),
+            # Loop timing metrics
+            web.get("/api/stats", self.api_stats),
+        ])
 
     async def index(self, request):
-        html = (TEMPLATES_DIR / "camera.html").read_text()
-        return web.Response(text=html, content_type="text/html")
+        try:
+            html, etag = self._load_template("camera.html")
+        except FileNotFoundError:
+            return web.Response(body=_FALLBACK_HTML, content_type="text/html")
+        # Content-hash ETag: a reloading browser sends If-None-Match and
+        # gets a header-only 304 instead of the ~20 KB page body.
+        # no-cache means "revalidate every time", NOT "don't cache" - so
+        # edits to the template still show up on the next reload.
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304)
+        return web.Response(
+            text=html, content_type="text/html",
+            headers={"ETag": etag, "Cache-Control": "no-cache"},
+        )
+
+    def _load_template(self, name: str) -> tuple[str, str]:
+        """Return (html, etag), re-reading the file only when it changed.
+
+        A stat() is far cheaper than open + read + decode + hash on
+        every page hit; comparing st_mtime_ns keeps editing the template
+        during development working, while steady-state requests are
+        served straight from memory.
+        """
+        path = TEMPLATES_DIR / name
+        mtime = path.stat().st_mtime_ns
+        cached = self._template_cache.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1], cached[2]
+        html = path.read_text()
+        etag = hashlib.blake2s(html.encode(), digest_size=16).hexdigest()
+        self._template_cache[name] = (mtime, html, etag)
+        return html, etag
 
     async def stream_camera(self, request):
         """MJPEG stream with bounding boxes."""
-        response = web.StreamResponse()
-        response.content_type = "multipart/x-mixed-replace; boundary=frame"
-        await response.prepare(request)
-        try:
-            while True:
-                if self.camera.is_running:
-                    jpeg = self.camera.get_jpeg_frame()
-                    if jpeg:
-                        await response.write(
-                            b"--frame\r\n"
-                            b"Content-Type: image/jpeg\r\n\r\n"
-                            + jpeg + b"\r\n"
-                        )
-                await asyncio.sleep(0.05)
-        except (ConnectionResetError, ConnectionAbortedError):
-            pass
-        return response
+        return await self._stream(request, self._brokers["camera"])
 
     async def stream_camera_mask(self, request):
         """MJPEG stream of a single color mask."""
         color = request.match_info["color"]
         if color not in ("red", "green", "magenta"):
             return web.Response(status=404, text="Unknown color")
+        return await self._stream(request, self._brokers[color])
 
-        response = web.StreamResponse()
-        response.content_type = "multipart/x-mixed-replace; boundary=frame"
-        await response.prepare(request)
+    async def _stream(self, request, broker: FrameBroker):
+        """Write broker frames to one client until it disconnects."""
+        broker.add_subscriber()
         try:
+            response = web.StreamResponse()
+            response.content_type = "multipart/x-mixed-replace; boundary=frame"
+            await response.prepare(request)
+
+            # Disable Nagle for this stream: each MJPEG part must leave
+            # NOW, not sit in the kernel hoping to coalesce with the next
+            # frame (on some clients that shows up as ~40 ms extra lag).
+            sock = request.transport.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            seq = 0
             while True:
-                if self.camera.is_running:
-                    jpeg = self.camera.get_jpeg_mask(color)
-                    if jpeg:
-                        await response.write(
-                            b"--frame\r\n"
-                            b"Content-Type: image/jpeg\r\n\r\n"
-                            + jpeg + b"\r\n"
-                        )
-                await asyncio.sleep(0.05)
+                seq, jpeg = await broker.next_frame(seq)
+                # One joined write = one syscall per frame. The small
+                # join allocation is cheaper than two extra socket writes.
+                await response.write(b"".join((_MJPEG_PREFIX, jpeg, _MJPEG_SUFFIX)))
         except (ConnectionResetError, ConnectionAbortedError):
             pass
+        finally:
+            broker.remove_subscriber()
         return response
 
+    async def _on_cleanup(self, app):
+        for broker in self._brokers.values():
+            await broker.stop()
+        self._jpeg_executor.shutdown(wait=False)
+
+    @staticmethod
+    async def _on_response_prepare(request, response):
+        """Attach standard headers in one place instead of per handler.
+
+        /api/ responses are live state - an intermediary caching them
+        would feed the UI stale params, so mark them no-store. nosniff
+        stops browsers second-guessing our content types.
+        """
+        if request.path.startswith("/api/"):
+            response.headers["Cache-Control"] = "no-store"
+        response.headers["X-Content-Type-Options"] = "nosniff"
+
+    async def api_stats(self, request):
+        """GET /api/stats - Capture FPS and detection timing."""
+        return web.json_response(self.camera.get_stats())
+
     # ── Parameters API ───────────────────────────────────────────
 
     async def api_params_get(self, request):
@@ -128,7 +305,11 @@ class WebServer:
 async def run_server(camera, params, host="0.0.0.0", port=8080):
     """Start the web server."""
     server = WebServer(camera, params)
-    runner = web.AppRunner(server.app)
+    # 75 s keep-alive (nginx's default): the tuning page polls
+    # /api/params and /api/stats at a slow cadence, and aiohttp's
+    # default 15 s would drop the connection between polls, forcing a
+    # TCP re-handshake each time.
+    runner = web.AppRunner(server.app, keepalive_timeout=75)
     await runner.setup()
     site = web.TCPSite(runner, host, port)
     await site.start()